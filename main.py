@@ -1,33 +1,85 @@
+import numpy as np
 import sounddevice as sd
 import mido
 import time
 import threading
 import psutil
 import logging
+from ringbuf import RingBuffer
+from waitress import serve
 
 from src.engine import Voice, Engine
 import web.app as web_app # Import the web app module
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+log = logging.getLogger() # Hot paths check log.isEnabledFor() before building f-strings
 
 # Global engine instance
 engine = None
 midi_handler = None
+xrun_count = 0 # Renderer underruns and output underflows; only the audio writer increments it
 
-def audio_callback(outdata, frames, time, status):
-    if status:
-        logging.warning(status)
-    chunk = engine.get_audio_chunk(frames)
-    outdata[:] = chunk.reshape(outdata.shape)
+BLOCK_SIZE = 1024 # Frames rendered and written per stream.write() call
+RENDER_BLOCKS = 2 # Blocks rendered per engine call, to amortize Python overhead
+RING_BUFFER_BLOCKS = 4 # Blocks of headroom between the renderer and the writer
+WEB_SERVER_THREADS = 8 # Each open /status_stream holds one thread, so leave room for requests
+XRUN_LOG_INTERVAL = 1.0 # Seconds between xrun reports
+CPU_POLL_INTERVAL = 1.0 # Seconds per CPU usage sample
+CPU_NOTIFY_THRESHOLD = 1.0 # Percentage points of CPU change worth pushing to status listeners
+TAP_HISTORY = 4 # Tap intervals kept for tempo detection
+
+def audio_renderer(buffer, frames, n_blocks):
+    """Renders macroblocks of n_blocks chunks into the ring buffer whenever it has room."""
+    idle_time = frames / engine.samplerate / 2
+    while True:
+        if buffer.write_available >= frames * n_blocks:
+            buffer.push(engine.render_macroblock(n_blocks, frames))
+        else:
+            time.sleep(idle_time)
+
+def audio_writer(stream, buffer, frames):
+    """Pops rendered audio from the ring buffer and writes it to the output stream.
+
+    stream.write() blocks inside PortAudio with the GIL released, and the
+    SPSC ring buffer needs no lock, so a render stall never holds up the device.
+    Xruns are only counted here; xrun_logger reports them from its own thread.
+    """
+    global xrun_count
+    silence = np.zeros(frames, dtype=np.float32)
+    while stream.active:
+        popped = buffer.pop(frames)
+        if popped is None:
+            xrun_count += 1
+            chunk = silence
+        else:
+            chunk = np.asarray(popped)
+        underflowed = stream.write(chunk.reshape(-1, 1))
+        if underflowed:
+            xrun_count += 1
+
+def xrun_logger():
+    """Logs any new xruns once per interval, keeping logging off the audio writer thread."""
+    logged_count = 0
+    while True:
+        time.sleep(XRUN_LOG_INTERVAL)
+        count = xrun_count
+        if count != logged_count:
+            logging.warning(f"{count - logged_count} audio xruns in the last {XRUN_LOG_INTERVAL:.0f}s ({count} total)")
+            logged_count = count
 
 class MidiInputHandler:
     def __init__(self, engine):
         self.engine = engine
         self.last_tap_time = 0
-        self.tap_times = []
+        # Ring of the last TAP_HISTORY tap intervals; tap_n of them are filled
+        self.tap_times = np.zeros(TAP_HISTORY, dtype=np.float64)
+        self.tap_idx = 0
+        self.tap_n = 0
         self.midi_port = None
         self.latest_midi_message = None # New attribute to store the latest MIDI message
+        # Handlers by MIDI message type; other types are ignored
+        self._handlers = {'note_on': self._on_note_on}
 
     def open_midi_port(self, port_name=None):
         try:
@@ -65,7 +117,8 @@ class MidiInputHandler:
             logging.info("Available MIDI input ports:", mido.get_input_names())
 
     def midi_callback(self, message):
-        logging.info(f"MIDI callback received: {message} (Type: {type(message)})")
+        if log.isEnabledFor(logging.INFO):
+            logging.info(f"MIDI callback received: {message} (Type: {type(message)})")
 
         # Store the latest MIDI message
         if isinstance(message, mido.Message):
@@ -79,12 +132,13 @@ class MidiInputHandler:
             self.latest_midi_message = message
         else:
             self.latest_midi_message = {'type': 'unknown', 'raw': str(message)}
+        self.engine.notify_state_change()
 
         # This method can now receive either a mido.Message object or a dict from the web app
         if isinstance(message, mido.Message):
             msg_type = message.type
-            msg_note = message.note
-            msg_velocity = message.velocity
+            msg_note = getattr(message, 'note', None)
+            msg_velocity = getattr(message, 'velocity', None)
         elif isinstance(message, dict):
             msg_type = message.get('type')
             msg_note = message.get('note')
@@ -93,41 +147,59 @@ class MidiInputHandler:
             logging.warning(f"Unknown message type received by MIDI handler: {type(message)}")
             return
 
-        if msg_type == 'note_on':
+        handler = self._handlers.get(msg_type)
+        if handler:
+            handler(msg_note, msg_velocity)
+        elif log.isEnabledFor(logging.INFO):
+            logging.info(f"Ignoring MIDI message type: {msg_type}")
+
+    def _on_note_on(self, msg_note, msg_velocity):
+        log_info = log.isEnabledFor(logging.INFO)
+        if log_info:
             logging.info(f"Processing note_on message: {msg_note}, velocity: {msg_velocity}")
-            # Tap tempo (e.g., C3 - MIDI note 41)
-            if msg_note == 41 and msg_velocity > 0:
-                current_time = time.time()
+        # Tap tempo (e.g., C3 - MIDI note 41)
+        if msg_note == 41 and msg_velocity > 0:
+            current_time = time.time()
+            if log_info:
                 logging.info(f"Tap tempo note (41) received. Current time: {current_time}, Last tap time: {self.last_tap_time}")
-                if self.last_tap_time != 0:
-                    interval = current_time - self.last_tap_time
-                    self.tap_times.append(interval)
-                    logging.info(f"Interval: {interval:.4f}s. Tap times: {self.tap_times}")
-                    if len(self.tap_times) > 4:  # Keep last 4 taps for average
-                        self.tap_times.pop(0)
-                    
-                    if len(self.tap_times) >= 2:
-                        avg_interval = sum(self.tap_times) / len(self.tap_times)
-                        new_bpm = 60 / avg_interval
+            if self.last_tap_time != 0:
+                interval = current_time - self.last_tap_time
+                self.tap_times[self.tap_idx] = interval
+                self.tap_idx = (self.tap_idx + 1) % TAP_HISTORY
+                self.tap_n = min(self.tap_n + 1, TAP_HISTORY)
+                if log_info:
+                    logging.info(f"Interval: {interval:.4f}s. Tap times: {self.tap_times[:self.tap_n]}")
+
+                if self.tap_n >= 2:
+                    # Median rather than mean, so one late or early tap doesn't drag the tempo
+                    median_interval = float(np.median(self.tap_times[:self.tap_n]))
+                    new_bpm = 60 / median_interval
+                    if log_info:
                         logging.info(f"Tap tempo calculated. Setting BPM to: {new_bpm:.2f}")
-                        self.engine.global_clock.bpm = new_bpm
-                self.last_tap_time = current_time
-            
-            # Loop control (e.g., C4 - MIDI note 60 for voice 0, C#4 - MIDI note 61 for voice 1)
-            elif 60 <= msg_note < 60 + len(self.engine.voices):
-                voice_index = msg_note - 60
-                # For now, just print. Later, we'll implement mute/unmute or trigger.
+                    self.engine.global_clock.bpm = new_bpm
+                    self.engine.notify_state_change()
+            self.last_tap_time = current_time
+
+        # Loop control (e.g., C4 - MIDI note 60 for voice 0, C#4 - MIDI note 61 for voice 1)
+        elif 60 <= msg_note < 60 + len(self.engine.voices):
+            voice_index = msg_note - 60
+            # For now, just print. Later, we'll implement mute/unmute or trigger.
+            if log_info:
                 logging.info(f"MIDI Note On: {msg_note} for Voice {voice_index}")
-        else:
-            logging.info(f"Ignoring MIDI message type: {msg_type}")
 
     def close_midi_port(self):
         if self.midi_port:
             self.midi_port.close()
             logging.info("MIDI port closed.")
 
-def get_cpu_usage():
-    return psutil.cpu_percent(interval=None) # Non-blocking call
+def cpu_poller():
+    """Publishes CPU usage to the engine from a background thread."""
+    while True:
+        # Blocks for the whole interval and measures usage across it
+        cpu_usage = psutil.cpu_percent(interval=CPU_POLL_INTERVAL)
+        if abs(cpu_usage - engine.cpu_usage) >= CPU_NOTIFY_THRESHOLD:
+            engine.cpu_usage = cpu_usage
+            engine.notify_state_change()
 
 def get_audio_output_devices():
     devices = sd.query_devices()
@@ -146,7 +218,8 @@ def get_audio_output_devices():
     return output_devices
 
 def run_flask_app():
-    web_app.app.run(host='0.0.0.0', port=5000, debug=False) # debug=False for production
+    # Threaded WSGI server instead of Werkzeug's development server
+    serve(web_app.app, host='0.0.0.0', port=5000, threads=WEB_SERVER_THREADS)
 
 if __name__ == "__main__":
     # Configure sounddevice to use JACK
@@ -175,14 +248,31 @@ if __name__ == "__main__":
     flask_thread.daemon = True # Daemonize thread so it exits when main thread exits
     flask_thread.start()
 
-    with sd.OutputStream(channels=1, callback=audio_callback, samplerate=samplerate):
+    # Write-based stream: no callback runs Python code on PortAudio's realtime thread
+    with sd.OutputStream(samplerate=samplerate, channels=1, dtype='float32',
+                         blocksize=BLOCK_SIZE, latency='high') as stream:
+        buffer = RingBuffer(format='f', capacity=BLOCK_SIZE * RING_BUFFER_BLOCKS)
+
+        renderer_thread = threading.Thread(target=audio_renderer, args=(buffer, BLOCK_SIZE, RENDER_BLOCKS))
+        renderer_thread.daemon = True
+        renderer_thread.start()
+
+        writer_thread = threading.Thread(target=audio_writer, args=(stream, buffer, BLOCK_SIZE))
+        writer_thread.daemon = True
+        writer_thread.start()
+
+        xrun_thread = threading.Thread(target=xrun_logger)
+        xrun_thread.daemon = True
+        xrun_thread.start()
+
+        cpu_thread = threading.Thread(target=cpu_poller)
+        cpu_thread.daemon = True
+        cpu_thread.start()
+
         logging.info("Playing audio. Press Ctrl+C to stop.")
         try:
             while True:
-                # Update Flask engine's CPU usage from the main engine's global clock
-                # BPM is directly linked via web_app.engine.global_clock.bpm
-                web_app.engine.cpu_usage = get_cpu_usage()
-                time.sleep(0.1) # Keep main thread alive and allow Flask thread to run
+                time.sleep(3600) # Keep main thread alive; all work happens on background threads
         except KeyboardInterrupt:
             logging.info("\nPlayback stopped.")
         finally:
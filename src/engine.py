@@ -1,30 +1,85 @@
+import os
+import threading
 import numpy as np
 import sounddevice as sd
 import soundfile as sf
 
-class Grain:
-    """A single audio grain."""
-    def __init__(self, buffer, start_pos, length, envelope):
-        self.buffer = buffer
-        self.start_pos = start_pos
-        self.length = length
-        self.envelope = envelope
-        self.current_pos = 0
-
-    def get_chunk(self, size):
-        """Get the next chunk of audio data from the grain."""
-        remaining = self.length - self.current_pos
-        if remaining == 0:
-            return None
-        
-        chunk_size = min(size, remaining)
-        chunk = self.buffer[self.start_pos + self.current_pos : self.start_pos + self.current_pos + chunk_size]
-        
-        # Apply envelope
-        chunk *= self.envelope[self.current_pos : self.current_pos + chunk_size]
-        
-        self.current_pos += chunk_size
-        return chunk
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError: # Numba has no wheels for some targets (e.g. 32-bit Raspberry Pi OS)
+    HAVE_NUMBA = False
+
+    def njit(*args, **kwargs):
+        """Leaves the function as plain Python; Voice mixes with _mix_grains_numpy instead."""
+        return lambda func: func
+
+AUDIO_CACHE_SUFFIX = '.f32' # Raw mono float32 copy of a loop, memory-mapped for playback
+AUDIO_CACHE_BLOCK = 65536 # Frames decoded at a time when building the cache
+MAX_BLOCK = 8192 # Largest number of frames rendered in one call
+MAX_GRAINS = 32 # Per voice; new grains are skipped once this many are playing
+
+_FRAME_OFFSETS = np.arange(MAX_BLOCK, dtype=np.int32)
+
+# Eager signature: compiled at import, so the first audio block doesn't pay for JIT.
+# nogil lets the Flask and MIDI threads run on other cores while grains are mixed.
+@njit("void(float32[::1], float32[::1], float32[::1], int32[::1], int32[::1])", nogil=True, cache=True, fastmath=True)
+def mix_grains(out, audio, hann, start_pos, cur_pos):
+    """Mixes the enveloped audio of each grain into out.
+
+    Grain i reads audio from start_pos[i] + cur_pos[i] and the envelope from
+    cur_pos[i]; grains shorter than out stop at the end of the envelope. A
+    negative cur_pos delays the grain by that many samples into out.
+    """
+    grain_length = hann.shape[0]
+    for g in range(start_pos.shape[0]):
+        cur = cur_pos[g]
+        start = start_pos[g] + cur
+        first = max(0, -cur)
+        last = min(out.shape[0], grain_length - cur)
+        for i in range(first, last):
+            out[i] += audio[start + i] * hann[cur + i]
+
+@njit("intp(int32[::1], int32[::1], intp, intp)", nogil=True, cache=True)
+def advance_grains(grain_start, grain_cur, frames, grain_length):
+    """Advances every grain by frames and compacts finished grains out in place.
+
+    Returns how many grains are still playing; they are packed at the front of the arrays.
+    """
+    write = 0
+    for read in range(grain_start.shape[0]):
+        cur = grain_cur[read] + frames
+        if cur < grain_length:
+            grain_start[write] = grain_start[read]
+            grain_cur[write] = cur
+            write += 1
+    return write
+
+def _mix_grains_numpy(out, audio, hann, start_pos, cur_pos, scratch):
+    """Vectorized NumPy version of mix_grains, used when Numba is unavailable.
+
+    Every grain is gathered through one (grains, frames) index grid. Positions
+    before the start or past the end of a grain are clipped onto the first or
+    last window sample, which np.hanning makes exactly zero, so they add
+    nothing to the mix. scratch is
+    a preallocated (int32, float32, float32) triple of flat buffers holding
+    at least grains * frames items, so nothing is allocated per block.
+    """
+    n, frames = start_pos.shape[0], out.shape[0]
+    pos_buf, grain_buf, env_buf = scratch
+    pos = pos_buf[:n * frames].reshape(n, frames)
+    grains = grain_buf[:n * frames].reshape(n, frames)
+    env = env_buf[:n * frames].reshape(n, frames)
+
+    np.add(cur_pos[:, None], _FRAME_OFFSETS[:frames], out=pos)
+    np.take(hann, pos, mode='clip', out=env)
+    np.add(pos, start_pos[:, None], out=pos)
+    np.take(audio, pos, mode='clip', out=grains)
+    np.multiply(grains, env, out=grains)
+
+    mix = env_buf[:frames] # The envelopes are spent, so reuse their buffer for the sum
+    np.sum(grains, axis=0, out=mix)
+    np.add(out, mix, out=out)
 
 class Voice:
     """A single voice that plays a loop using granular synthesis."""
@@ -32,40 +87,70 @@ class Voice:
         self.audio_data, self.samplerate = self.load_audio(audio_file)
         self.grain_length = int(self.samplerate * (grain_length_ms / 1000))
         self.grain_rate_hz = grain_rate_hz
-        self.hann_window = np.hanning(self.grain_length)
-        self.active_grains = []
-        self.grain_scheduler = GrainScheduler(self.samplerate, self.grain_rate_hz, self.spawn_grain)
+        self.hann_window = np.hanning(self.grain_length).astype(np.float32)
+        # Grains are stored as parallel arrays; slots [0, n_active) are playing
+        self.grain_start = np.empty(MAX_GRAINS, dtype=np.int32)
+        self.grain_cur = np.empty(MAX_GRAINS, dtype=np.int32)
+        self.n_active = 0
+        self._out = np.zeros(MAX_BLOCK, dtype=np.float32)
+        if not HAVE_NUMBA:
+            self._scratch = (np.empty(MAX_GRAINS * MAX_BLOCK, dtype=np.int32),
+                             np.empty(MAX_GRAINS * MAX_BLOCK, dtype=np.float32),
+                             np.empty(MAX_GRAINS * MAX_BLOCK, dtype=np.float32))
+        self.grain_scheduler = GrainScheduler(self.samplerate, self.grain_rate_hz, self.spawn_grains)
         self.position = 0
+        self._hop = int(self.grain_length * 0.5) # 50% overlap
+        self._wrap = len(self.audio_data) - self.grain_length # Grain starts loop back within [0, _wrap)
 
     def load_audio(self, audio_file):
-        """Loads an audio file."""
-        data, samplerate = sf.read(audio_file)
-        return data, samplerate
-
-    def spawn_grain():
-        """Spawns a new grain."""
-        start_pos = self.position
-        grain = Grain(self.audio_data, start_pos, self.grain_length, self.hann_window)
-        self.active_grains.append(grain)
-        
+        """Loads an audio file as a memory-mapped mono float32 buffer.
+
+        The file is decoded once into a raw cache next to it (rebuilt when the
+        source is newer); the OS page cache then handles prefetching.
+        """
+        samplerate = sf.info(audio_file).samplerate
+        cache_file = os.path.splitext(audio_file)[0] + AUDIO_CACHE_SUFFIX
+        if not os.path.exists(cache_file) or os.path.getmtime(cache_file) < os.path.getmtime(audio_file):
+            tmp_file = cache_file + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                for block in sf.blocks(audio_file, blocksize=AUDIO_CACHE_BLOCK, dtype='float32', always_2d=True):
+                    block.mean(axis=1, dtype=np.float32).tofile(f) # Mix down to mono
+            os.replace(tmp_file, cache_file)
+        # Copy-on-write rather than read-only, so Numba's writable-array signatures accept it
+        return np.memmap(cache_file, dtype=np.float32, mode='c'), samplerate
+
+    def spawn_grains(self, offsets):
+        """Spawns grains at successive positions through the loop.
+
+        offsets gives each grain's start, in samples, into the next rendered chunk.
+        """
+        count = min(len(offsets), MAX_GRAINS - self.n_active) # Skip grains rather than grow the arrays on the audio thread
+        if count <= 0:
+            return
+        n = self.n_active
+        self.grain_start[n:n + count] = (self.position + np.arange(count) * self._hop) % self._wrap
+        self.grain_cur[n:n + count] = -offsets[:count] # Negative position delays the grain within the chunk
+        self.n_active += count
+
         # Advance position for the next grain
-        self.position += int(self.grain_length * 0.5) # 50% overlap
-        if self.position + self.grain_length >= len(self.audio_data):
-            self.position = 0 # Loop back to the beginning
+        self.position = (self.position + count * self._hop) % self._wrap
 
     def get_audio_chunk(self, chunk_size):
         """Generates the next chunk of audio data."""
-        self.grain_scheduler.tick()
-        
-        output_buffer = np.zeros(chunk_size, dtype=np.int16)
-        
-        for grain in self.active_grains[:]:
-            chunk = grain.get_chunk(chunk_size)
-            if chunk is not None:
-                output_buffer[:len(chunk)] += chunk.astype(np.int16)
+        self.grain_scheduler.tick(chunk_size)
+
+        output_buffer = self._out[:chunk_size]
+        output_buffer[:] = 0
+
+        n = self.n_active
+        if n:
+            if HAVE_NUMBA:
+                mix_grains(output_buffer, self.audio_data, self.hann_window, self.grain_start[:n], self.grain_cur[:n])
             else:
-                self.active_grains.remove(grain)
-                
+                _mix_grains_numpy(output_buffer, self.audio_data, self.hann_window,
+                                  self.grain_start[:n], self.grain_cur[:n], self._scratch)
+            self.n_active = advance_grains(self.grain_start[:n], self.grain_cur[:n], chunk_size, self.grain_length)
+
         return output_buffer
 
 class GlobalClock:
@@ -90,12 +175,17 @@ class GrainScheduler:
         self.samples_per_grain_interval = self.samplerate / self.grain_rate_hz
         self.samples_until_next_grain = self.samples_per_grain_interval
 
-    def tick(self):
-        """Should be called for every audio sample."""
-        self.samples_until_next_grain -= 1
+    def tick(self, frames):
+        """Advances the scheduler by one block of frames, spawning any grains due in it.
+
+        spawn_callback receives the sample offset of each due grain into the block.
+        """
+        self.samples_until_next_grain -= frames
         if self.samples_until_next_grain <= 0:
-            self.spawn_callback()
-            self.samples_until_next_grain = self.samples_per_grain_interval
+            count = int(-self.samples_until_next_grain // self.samples_per_grain_interval) + 1
+            offsets = frames + self.samples_until_next_grain + np.arange(count) * self.samples_per_grain_interval
+            self.samples_until_next_grain += count * self.samples_per_grain_interval
+            self.spawn_callback(offsets.astype(np.int32))
 
 class Engine:
     """Manages multiple Voice objects and the global clock."""
@@ -103,13 +193,37 @@ class Engine:
         self.samplerate = samplerate
         self.global_clock = GlobalClock(samplerate, bpm)
         self.voices = []
+        self.cpu_usage = 0.0
+        self._out = np.zeros(MAX_BLOCK, dtype=np.float32)
+        # Status listeners wait on state_cond until state_version moves on
+        self.state_cond = threading.Condition()
+        self.state_version = 0
 
     def add_voice(self, voice):
         self.voices.append(voice)
 
+    def notify_state_change(self):
+        """Wakes status listeners after a BPM, MIDI or CPU usage change."""
+        with self.state_cond:
+            self.state_version += 1
+            self.state_cond.notify_all()
+
+    def render_macroblock(self, n_blocks, frames):
+        """Renders n_blocks blocks of frames with a single pass through the engine.
+
+        Grains start on their exact sample, so this sounds the same as n_blocks
+        separate calls while paying the per-call Python overhead only once.
+        """
+        total = n_blocks * frames
+        if total > MAX_BLOCK:
+            raise ValueError(f"Macroblock of {total} frames exceeds MAX_BLOCK ({MAX_BLOCK})")
+        return self.get_audio_chunk(total)
+
     def get_audio_chunk(self, frames):
         self.global_clock.tick(frames)
-        output_buffer = np.zeros(frames, dtype=np.int16)
+        # A view of a reused buffer: callers must consume it before the next call
+        output_buffer = self._out[:frames]
+        output_buffer[:] = 0
         for voice in self.voices:
             output_buffer += voice.get_audio_chunk(frames)
         return output_buffer
\ No newline at end of file
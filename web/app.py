@@ -3,11 +3,14 @@ import threading
 import time
 import sys
 import logging
-import json # Import json module
+import orjson
 
 # Configure logging for Flask app
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+STATUS_CACHE_SECONDS = 0.05 # /status serves the same JSON body for this long
+STATUS_KEEPALIVE_SECONDS = 15 # Idle SSE streams send a comment this often to detect disconnects
+
 # Global references to the actual engine and midi_handler
 # These will be set by main.py
 engine = None
@@ -17,26 +20,37 @@ get_audio_output_devices = None # Will be set by main.py
 
 app = Flask(__name__)
 
+# Last /status response body, shared by all request threads
+_status_cache = {'ts': 0.0, 'body': b''}
+_status_cache_lock = threading.Lock()
+
 @app.route('/')
 def index():
     return render_template('index.html')
 
 @app.route('/status')
 def status():
-    # Ensure engine is not None before accessing its attributes
-    current_bpm = engine.global_clock.bpm if engine else 0
-    current_cpu_usage = engine.cpu_usage if engine else 0.0
-    voices_status = []
-    if engine and engine.voices:
-        voices_status = [{'id': i, 'status': 'playing'} for i in range(len(engine.voices))] # Placeholder
-    latest_midi = midi_handler.latest_midi_message if midi_handler else None
-
-    return jsonify({
-        'bpm': current_bpm,
-        'voices': voices_status,
-        'cpu_usage': current_cpu_usage,
-        'latest_midi': latest_midi
-    })
+    with _status_cache_lock:
+        now = time.monotonic()
+        if now - _status_cache['ts'] >= STATUS_CACHE_SECONDS:
+            # Ensure engine is not None before accessing its attributes
+            current_bpm = engine.global_clock.bpm if engine else 0
+            current_cpu_usage = engine.cpu_usage if engine else 0.0
+            voices_status = []
+            if engine and engine.voices:
+                voices_status = [{'id': i, 'status': 'playing'} for i in range(len(engine.voices))] # Placeholder
+            latest_midi = midi_handler.latest_midi_message if midi_handler else None
+
+            _status_cache['body'] = orjson.dumps({
+                'bpm': current_bpm,
+                'voices': voices_status,
+                'cpu_usage': current_cpu_usage,
+                'latest_midi': latest_midi
+            })
+            _status_cache['ts'] = now
+        body = _status_cache['body']
+
+    return app.response_class(body, mimetype='application/json')
 
 @app.route('/tap')
 def tap():
@@ -54,6 +68,7 @@ def set_bpm():
     logging.info(f"Web /set_bpm endpoint hit with data: {data}")
     if new_bpm and engine:
         engine.global_clock.bpm = float(new_bpm)
+        engine.notify_state_change()
         return jsonify({'message': f'BPM set to {new_bpm}', 'bpm': engine.global_clock.bpm})
     return jsonify({'error': 'Invalid BPM or engine not initialized'}), 400
 
@@ -108,18 +123,27 @@ def set_audio_output_device():
 # SSE endpoint for live BPM and CPU updates
 @app.route('/status_stream')
 def status_stream():
+    if not engine:
+        return jsonify({'error': 'Engine not initialized'}), 500
+
     def generate():
+        seen_version = -1
         while True:
-            # Ensure engine is not None before accessing its attributes
-            current_bpm = engine.global_clock.bpm if engine else 0
-            current_cpu_usage = engine.cpu_usage if engine else 0.0
-            latest_midi = midi_handler.latest_midi_message if midi_handler else None
-            
-            # Serialize latest_midi to JSON string
-            latest_midi_json = json.dumps(latest_midi)
-
-            yield f"data: {{\"bpm\": {current_bpm}, \"cpu_usage\": {current_cpu_usage}, \"latest_midi\": {latest_midi_json}}}\n\n"
-            time.sleep(0.1) # Send updates every 100ms for smoother MIDI display
+            # Sleep until the engine reports a BPM, MIDI or CPU usage change
+            with engine.state_cond:
+                changed = engine.state_cond.wait_for(lambda: engine.state_version != seen_version,
+                                                     timeout=STATUS_KEEPALIVE_SECONDS)
+                seen_version = engine.state_version
+            if not changed:
+                yield b": keepalive\n\n"
+                continue
+
+            payload = orjson.dumps({
+                'bpm': engine.global_clock.bpm,
+                'cpu_usage': engine.cpu_usage,
+                'latest_midi': midi_handler.latest_midi_message if midi_handler else None
+            })
+            yield b"data: " + payload + b"\n\n"
     return app.response_class(generate(), mimetype='text/event-stream')
 
 # This part will not be executed when imported by main.py
@@ -135,6 +159,12 @@ if __name__ == '__main__':
             self.global_clock = DummyGlobalClock()
             self.voices = []
             self.cpu_usage = 0.0
+            self.state_cond = threading.Condition()
+            self.state_version = 0
+        def notify_state_change(self):
+            with self.state_cond:
+                self.state_version += 1
+                self.state_cond.notify_all()
 
     class DummyMidiHandler:
         def __init__(self):
@@ -146,6 +176,7 @@ if __name__ == '__main__':
             if message.get('note') == 41:
                 # Simulate BPM change for dummy engine
                 self.engine.global_clock.bpm += 1
+            self.engine.notify_state_change()
         def open_midi_port(self, port_name=None):
             logging.info(f"Dummy MIDI port opened: {port_name or 'default'}")
         def close_midi_port(self):